@@ -1,28 +1,66 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, Integer, String
+from pydantic import BaseModel, ConfigDict, Field, create_model
+from sqlalchemy import Column, Index, Integer, String, event, insert, select, text
+from sqlalchemy.exc import DataError, IntegrityError, InterfaceError, OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, async_scoped_session, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-from typing import Dict
 import os
+import asyncio
+import logging
+from bisect import bisect_left
+from uuid import uuid4
+from functools import lru_cache
+from contextvars import ContextVar
+from contextlib import asynccontextmanager
 from os.path import join, dirname
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
-try:
-    dotenv_path = join(dirname(__file__), '.env')
-    load_dotenv(dotenv_path)
-except Exception as e:
-    print(f"Environment not found: {e}")
-
-# Database Connection
-try:
-    DATABASE_URL = os.environ.get("DATABASE_URL")
-    engine = create_engine(DATABASE_URL)
-    SessionLocal = sessionmaker(bind=engine)
-except Exception as e:
-    print(f"Database not connected: {e}")
+load_dotenv(join(dirname(__file__), '.env'))
+
+# Database Connection: built lazily on first use so importing this module
+# (tests, --reload, worker fork) never touches the database
+@lru_cache(maxsize=1)
+def get_engine():
+    database_url = os.environ["DATABASE_URL"]
+    if os.environ.get("USE_PGBOUNCER"):
+        # PgBouncer (transaction pooling, port 6432) does the real pooling and
+        # can't keep server-side prepared statements across transactions
+        pool_options = dict(
+            pool_size=5,
+            max_overflow=0,
+            connect_args={
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+            },
+        )
+    else:
+        pool_options = dict(pool_size=20, max_overflow=10)
+    engine = create_async_engine(
+        database_url.replace("postgresql://", "postgresql+asyncpg://"),
+        pool_timeout=30,
+        pool_pre_ping=True,  # Drop stale connections before handing them out
+        pool_recycle=3600,
+        **pool_options,
+    )
+    if os.environ.get("DEBUG_SQL_INSERTS"):
+        event.listen(engine.sync_engine, "before_cursor_execute", count_inserts)
+    return engine
+
+@lru_cache(maxsize=1)
+def get_sessionmaker():
+    return async_sessionmaker(
+        get_engine(), class_=AsyncSession, expire_on_commit=False, autoflush=False
+    )
+
+# One session per request task, handed back to the registry in get_db
+@lru_cache(maxsize=1)
+def get_scoped_session():
+    return async_scoped_session(get_sessionmaker(), scopefunc=asyncio.current_task)
 
 # Define DB Models
 Base = declarative_base()
@@ -30,17 +68,18 @@ Base = declarative_base()
 class User(Base):
     __tablename__ = "user_information"
     user_id = Column(Integer, primary_key=True)  # Fixed: Removed server_default
-    account_name = Column(String(50), unique=True, nullable=False)
+    account_name = Column(String(50), unique=True, nullable=False, index=True)
     user_password = Column(String(50), nullable=False)
     surname = Column(String(100), nullable=False)
     firstname = Column(String(100), nullable=False)
     gender = Column(String(30), nullable=False)
-    email = Column(String(255), unique=True, nullable=False)
-    registerid = Column(String(12), unique=True, nullable=False)
+    email = Column(String(255), unique=True, nullable=False, index=True)
+    registerid = Column(String(12), unique=True, nullable=False, index=True)
     country = Column(String(50), nullable=True)
 
 class Isma(Base):
     __tablename__ = "isma_web"
+    __table_args__ = (Index("ix_isma_user_id", "user_id"),)
     isma_id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
     sleep_enough = Column(Integer)
@@ -72,6 +111,7 @@ class Isma(Base):
 
 class Insomnia(Base):
     __tablename__ = "insomnia_web"
+    __table_args__ = (Index("ix_insomnia_user_id", "user_id"),)
     insomnia_id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
     fall_asleep = Column(Integer)
@@ -86,6 +126,7 @@ class Insomnia(Base):
 
 class Fatigue(Base):
     __tablename__ = "fatigue"
+    __table_args__ = (Index("ix_fatigue_user_id", "user_id"),)
     fatigue_id = Column(Integer, primary_key=True)  # Fixed from insomnia_id
     user_id = Column(Integer, nullable=False)
     sleep_disorder = Column(Integer)
@@ -108,11 +149,46 @@ class Fatigue(Base):
     total_sum = Column(Integer)
     question_mn = Column(String)
 
-# Create all tables
-Base.metadata.create_all(bind=engine)
+# Prebuilt survey INSERT statements, reused (and compile-cached) across requests
+ISMA_INSERT = insert(Isma)
+INSOMNIA_INSERT = insert(Insomnia)
+FATIGUE_INSERT = insert(Fatigue)
+
+# Uniqueness pre-check for user creation: plain rows, no ORM hydration. Rows
+# matching the username sort first, then email, so the reported conflict follows
+# the same priority as the individual checks did
+EXISTS_USER = text(
+    "SELECT account_name, email, registerid FROM user_information "
+    "WHERE account_name = :u OR email = :e OR registerid = :r "
+    "ORDER BY (account_name = :u) DESC, (email = :e) DESC LIMIT 1"
+)
+
+# Unique user column -> 400 detail, used when a concurrent insert beats the pre-check
+USER_CONFLICT_DETAILS = (
+    ("account_name", "Username already registered"),
+    ("email", "Email already registered"),
+    ("registerid", "Register ID already registered"),
+)
+
+# Create all tables. Run once out-of-band (scripts/init_db.py) rather than on every worker boot
+async def init_models():
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+# App lifespan: optional table creation, then the survey flushers for as long
+# as the app is serving. Dev convenience: set AUTO_CREATE_TABLES=1 to create tables
+@asynccontextmanager
+async def lifespan(app):
+    if os.environ.get("AUTO_CREATE_TABLES"):
+        await init_models()
+    await start_survey_flushers()
+    try:
+        yield
+    finally:
+        await stop_survey_flushers()
 
 # FastAPI App
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -122,13 +198,145 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Debug check: set DEBUG_SQL_INSERTS=1 to log an error whenever a request, or a
+# batched survey flush, emits more than one INSERT
+_request_inserts = ContextVar("request_inserts", default=None)
+
+def count_inserts(conn, cursor, statement, parameters, context, executemany):
+    counter = _request_inserts.get()
+    if counter is not None and statement.lstrip().upper().startswith("INSERT"):
+        counter.append(statement)
+
+def report_insert_count(source, counter):
+    if len(counter) > 1:
+        logger.error("%s emitted %d INSERTs, expected at most 1: %s", source, len(counter), counter)
+
+if os.environ.get("DEBUG_SQL_INSERTS"):
+    @app.middleware("http")
+    async def check_insert_count(request, call_next):
+        counter = []
+        _request_inserts.set(counter)
+        response = await call_next(request)
+        report_insert_count(request.url.path, counter)
+        return response
+
 # Dependency to get DB session
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    registry = get_scoped_session()
     try:
-        yield db
+        yield registry()
     finally:
-        db.close()
+        await registry.remove()
+
+# Batched survey writes: endpoints enqueue rows, a background task per survey
+# flushes them with one executemany INSERT every SURVEY_FLUSH_INTERVAL seconds
+# or SURVEY_BATCH_SIZE rows. Clients only get question_mn back, so they never
+# need to wait for the row to be committed.
+SURVEY_BATCH_SIZE = 500
+SURVEY_FLUSH_INTERVAL = 0.05  # seconds
+# While the database is unreachable a batch is held and retried whole, backing
+# off from SURVEY_RETRY_MIN_DELAY up to SURVEY_RETRY_MAX_DELAY seconds
+SURVEY_RETRY_MIN_DELAY = 0.5
+SURVEY_RETRY_MAX_DELAY = 30
+SURVEY_SHUTDOWN_TIMEOUT = 30  # seconds to wait for queued rows on shutdown
+
+# Queues and their flusher tasks are created together on startup so they're
+# bound to the running event loop (one set per app lifespan)
+survey_queues = {}
+survey_flushers = {}
+
+async def insert_survey_rows(stmt, rows):
+    async with get_sessionmaker()() as db:
+        await db.execute(stmt, rows)
+        await db.commit()
+
+async def write_survey_batch(stmt, batch):
+    delay = SURVEY_RETRY_MIN_DELAY
+    while True:
+        # The whole batch should go out as a single executemany INSERT
+        counter = []
+        _request_inserts.set(counter)
+        try:
+            await insert_survey_rows(stmt, batch)
+        except (IntegrityError, DataError):
+            # Bad data: write rows one at a time so only the offending ones are lost
+            if len(batch) == 1:
+                logger.exception("Survey row for user_id=%s could not be written to %s",
+                                 batch[0]["user_id"], stmt.table.name)
+                return
+            logger.exception("Survey batch insert into %s failed, retrying %d rows one at a time",
+                             stmt.table.name, len(batch))
+            for row in batch:
+                await write_survey_batch(stmt, [row])
+            return
+        except (OperationalError, InterfaceError, OSError):
+            # Database unreachable: keep the batch and retry it whole, logging once
+            if delay == SURVEY_RETRY_MIN_DELAY:
+                logger.exception("Database unavailable, holding %d rows for %s and retrying",
+                                 len(batch), stmt.table.name)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SURVEY_RETRY_MAX_DELAY)
+            continue
+        if delay != SURVEY_RETRY_MIN_DELAY:
+            logger.warning("Database available again, wrote %d held rows to %s",
+                           len(batch), stmt.table.name)
+        report_insert_count(f"{stmt.table.name} batch of {len(batch)}", counter)
+        return
+
+async def flush_survey_queue(queue, stmt):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + SURVEY_FLUSH_INTERVAL
+        while len(batch) < SURVEY_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await write_survey_batch(stmt, batch)
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+def log_flusher_exit(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Survey flusher stopped", exc_info=task.exception())
+
+async def start_survey_flushers():
+    for stmt in (ISMA_INSERT, INSOMNIA_INSERT, FATIGUE_INSERT):
+        queue = asyncio.Queue(maxsize=SURVEY_BATCH_SIZE * 10)
+        survey_queues[stmt] = queue
+        survey_flushers[stmt] = asyncio.create_task(flush_survey_queue(queue, stmt))
+        survey_flushers[stmt].add_done_callback(log_flusher_exit)
+
+async def stop_survey_flushers():
+    # Let the live flushers write out everything already queued before stopping
+    # them; a finished flusher would never drain its queue, so don't wait on it,
+    # and don't wait forever on one stuck retrying against a dead database
+    for stmt, queue in survey_queues.items():
+        if survey_flushers[stmt].done():
+            continue
+        try:
+            await asyncio.wait_for(queue.join(), SURVEY_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Shutting down with %d queued rows (plus any batch in flight) unwritten for %s",
+                         queue.qsize(), stmt.table.name)
+    for task in survey_flushers.values():
+        task.cancel()
+    await asyncio.gather(*survey_flushers.values(), return_exceptions=True)
+    survey_queues.clear()
+    survey_flushers.clear()
+
+async def enqueue_survey_row(stmt, row):
+    # Queues only exist while the app lifespan is running
+    queue = survey_queues.get(stmt)
+    if queue is None or survey_flushers[stmt].done():
+        raise HTTPException(status_code=503, detail="Survey storage is not running")
+    await queue.put(row)
 
 # Pydantic Schema for User Creation
 class UserCreate(BaseModel):
@@ -141,10 +349,18 @@ class UserCreate(BaseModel):
     registry_number: str
     country: str | None
 
-# Pydantic Schema for Survey Submission
-class SurveySubmission(BaseModel):
-    responses: Dict[str, int]  # e.g., {"sleep_enough": 1, "appetite_change": 0}
+# Pydantic Schema for listing users (no password)
+class UserOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     user_id: int
+    account_name: str
+    surname: str
+    firstname: str
+    gender: str
+    email: str
+    registerid: str
+    country: str | None
 
 # Constant list of question IDs
 ISMA_QUESTIONS = [
@@ -169,15 +385,75 @@ FATIGUE_QUESTIONS = [
     "Allergic Reaction"
 ]
 
+# Score bands: each threshold is the inclusive upper bound of the label at the same index
+ISMA_THRESHOLDS = (5, 10)
+ISMA_LABELS = (
+    "Стрессээр өвчлөх магадлал бага",
+    "Стрессээр өвчлөх магадлал өндөр",
+    "Стрессийн түвшин маш өндөр байна",
+)
+INSOMNIA_THRESHOLDS = (7, 14, 21)
+INSOMNIA_LABELS = (
+    "Нойргүйдэл байхгүй",
+    "Нойргүйдлийн зэрэг бага",
+    "Дунд зэргийн нойргүйдэлтэй",
+    "Нойргүйдлийн зэрэг хүнд явцтай",
+)
+FATIGUE_THRESHOLDS = (10, 24, 51)
+FATIGUE_LABELS = (
+    "Архаг ядаргаатай",
+    "Бага зэргийн архаг ядаргаатай",
+    "Дунд зэргийн архаг ядаргаатай",
+    "Хүнд зэргийн архаг ядаргаатай",
+)
+
+# Precomputed question -> column name mappings
+INSOMNIA_KEY_MAP = {q: q.replace(" ", "_").lower() for q in INSOMNIA_QUESTIONS}
+FATIGUE_KEY_MAP = {q: q.replace(" ", "_").lower() for q in FATIGUE_QUESTIONS}
+
+# Pydantic Schemas for Survey Responses: one int field per question, so missing
+# or extra questions are rejected by validation and model_dump() yields column names
+IsmaResponses = create_model(
+    "IsmaResponses",
+    __config__=ConfigDict(extra="forbid"),
+    **{q: (int, ...) for q in ISMA_QUESTIONS},
+)
+InsomniaResponses = create_model(
+    "InsomniaResponses",
+    __config__=ConfigDict(extra="forbid"),
+    **{dst: (int, Field(alias=src)) for src, dst in INSOMNIA_KEY_MAP.items()},
+)
+FatigueResponses = create_model(
+    "FatigueResponses",
+    __config__=ConfigDict(extra="forbid"),
+    **{dst: (int, Field(alias=src)) for src, dst in FATIGUE_KEY_MAP.items()},
+)
+
+# Pydantic Schemas for Survey Submission
+class IsmaSubmission(BaseModel):
+    responses: IsmaResponses  # e.g., {"sleep_enough": 1, "appetite_change": 0, ...}
+    user_id: int
+
+class InsomniaSubmission(BaseModel):
+    responses: InsomniaResponses  # e.g., {"Fall Asleep": 1, "Stay Asleep": 0, ...}
+    user_id: int
+
+class FatigueSubmission(BaseModel):
+    responses: FatigueResponses  # e.g., {"Sleep Disorder": 1, "Waking Fatigue": 0, ...}
+    user_id: int
+
 # POST endpoint to create a user
 @app.post("/users/", response_model=UserCreate)
-async def create_user(user: UserCreate, db: Session = Depends(get_db)):
-    # Check for existing username, email, or registerid
-    if db.query(User).filter(User.account_name == user.username).first():
-        raise HTTPException(status_code=400, detail="Username already registered")
-    if db.query(User).filter(User.email == user.email).first():
-        raise HTTPException(status_code=400, detail="Email already registered")
-    if db.query(User).filter(User.registerid == user.registry_number).first():
+async def create_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
+    # Check for existing username, email, or registerid in a single round-trip
+    existing = (await db.execute(
+        EXISTS_USER, {"u": user.username, "e": user.email, "r": user.registry_number}
+    )).first()
+    if existing:
+        if existing.account_name == user.username:
+            raise HTTPException(status_code=400, detail="Username already registered")
+        if existing.email == user.email:
+            raise HTTPException(status_code=400, detail="Email already registered")
         raise HTTPException(status_code=400, detail="Register ID already registered")
     
     new_user = User(
@@ -191,110 +467,94 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
         country=user.country if user.country else None
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    try:
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        # Only unique violations are conflicts; Postgres names the column in the
+        # error detail, e.g. "Key (email)=(a@b.mn) already exists."
+        if getattr(e.orig, "sqlstate", None) == "23505":
+            key = getattr(e.orig, "detail", None) or ""
+            for column, detail in USER_CONFLICT_DETAILS:
+                if key.startswith(f"Key ({column})="):
+                    raise HTTPException(status_code=400, detail=detail) from e
+        raise
     return user
 
 # GET endpoint to fetch all users
-@app.get("/users/")
-async def get_users(db: Session = Depends(get_db)):
-    return db.query(User).all()
+@app.get("/users/", response_model=list[UserOut])
+async def get_users(
+    limit: int | None = Query(None, ge=0),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_db),
+):
+    # Plain column rows (no ORM objects, no password), validated by UserOut
+    return (await db.execute(
+        select(
+            User.user_id, User.account_name, User.surname, User.firstname,
+            User.gender, User.email, User.registerid, User.country,
+        ).order_by(User.user_id).limit(limit).offset(offset)
+    )).all()
 
 # POST endpoint to submit survey
 @app.post("/survey/isma")
-async def submit_isma_survey(submission: SurveySubmission, db: Session = Depends(get_db)):
-    # Validate that all expected questions are present and no extras
-    if set(ISMA_QUESTIONS) != set(submission.responses.keys()):
-        raise HTTPException(status_code=400, detail="Missing or extra questions in submission")
-    
+async def submit_isma_survey(submission: IsmaSubmission):
+    # Individual responses keyed by Isma column (presence already validated)
+    isma_data = submission.responses.model_dump()
+
     # Calculate total sum of responses
-    total_sum = sum(submission.responses.values())
+    total_sum = sum(isma_data.values())
 
     # Determine question_mn based on total_sum
-    if total_sum <= 5:
-        question_mn = "Стрессээр өвчлөх магадлал бага"
-    elif total_sum <= 10:
-        question_mn = "Стрессээр өвчлөх магадлал өндөр"
-    else:
-        question_mn = "Стрессийн түвшин маш өндөр байна"
+    question_mn = ISMA_LABELS[bisect_left(ISMA_THRESHOLDS, total_sum)]
     
-    # Prepare data for Isma model with individual responses
-    isma_data = {q: submission.responses[q] for q in ISMA_QUESTIONS}
-    isma_data["user_id"] = submission.user_idisma_data
+    # Prepare data for Isma model
+    isma_data["user_id"] = submission.user_id
     isma_data["total_sum"] = total_sum
     isma_data["question_mn"] = question_mn
     
-    # Insert into Isma table
-    new_isma = Isma(**isma_data)
-    db.add(new_isma)
-    db.commit()
-    db.refresh(new_isma)
+    # Queue for batched insert into Isma table
+    await enqueue_survey_row(ISMA_INSERT, isma_data)
     
     # Return question_mn to frontend
     return {"question_mn": question_mn}
 
 @app.post("/survey/insomnia")
-async def submit_insomnia_survey(submission: SurveySubmission, db: Session = Depends(get_db)):
-    # Validate that all expected questions are present and no extras
-    if set(INSOMNIA_QUESTIONS) != set(submission.responses.keys()):
-        raise HTTPException(status_code=400, detail="Missing or extra questions in submission")
-    
+async def submit_insomnia_survey(submission: InsomniaSubmission):
+    # Individual responses keyed by Insomnia column (presence already validated)
+    insomnia_data = submission.responses.model_dump()
+
     # Calculate total sum of responses
-    total_sum = sum(submission.responses.values())
+    total_sum = sum(insomnia_data.values())
 
     # Determine question_mn based on total_sum
-    if total_sum < 8:
-        question_mn = "Нойргүйдэл байхгүй"
-    elif total_sum < 15:
-        question_mn = "Нойргүйдлийн зэрэг бага"
-    elif total_sum < 22:
-        question_mn = "Дунд зэргийн нойргүйдэлтэй"
-    else:
-        question_mn = "Нойргүйдлийн зэрэг хүнд явцтай"
+    question_mn = INSOMNIA_LABELS[bisect_left(INSOMNIA_THRESHOLDS, total_sum)]
     
-    # Prepare data for Isma model with individual responses
-    insomnia_data = {
-        q.replace(" ", "_").lower(): submission.responses[q] 
-        for q in INSOMNIA_QUESTIONS
-    }
+    # Prepare data for Insomnia model
     insomnia_data["user_id"] = submission.user_id
     insomnia_data["total_sum"] = total_sum
     insomnia_data["question_mn"] = question_mn
     
-    # Insert into Isma table
-    new_insomnia = Insomnia(**insomnia_data)
-    db.add(new_insomnia)
-    db.commit()
-    db.refresh(new_insomnia)
+    # Queue for batched insert into Insomnia table
+    await enqueue_survey_row(INSOMNIA_INSERT, insomnia_data)
     
     # Return question_mn to frontend
     return {"question_mn": question_mn}
 
 @app.post("/survey/fatigue")
-async def submit_fatigue_survey(submission: SurveySubmission, db: Session = Depends(get_db)):
-    if set(FATIGUE_QUESTIONS) != set(submission.responses.keys()):
-        raise HTTPException(status_code=400, detail="Missing or extra questions in Fatigue submission")
-    
-    total_sum = sum(submission.responses.values())
-    if total_sum <= 10:
-        question_mn = "Архаг ядаргаатай"
-    elif total_sum <= 24:
-        question_mn = "Бага зэргийн архаг ядаргаатай"
-    elif total_sum <= 51:
-        question_mn = "Дунд зэргийн архаг ядаргаатай"
-    else:
-        question_mn = "Хүнд зэргийн архаг ядаргаатай"
+async def submit_fatigue_survey(submission: FatigueSubmission):
+    # Responses come back keyed by Fatigue model columns
+    fatigue_data = submission.responses.model_dump()
+    total_sum = sum(fatigue_data.values())
+
+    # Determine question_mn based on total_sum
+    question_mn = FATIGUE_LABELS[bisect_left(FATIGUE_THRESHOLDS, total_sum)]
     
-    # Transform keys to match Fatigue model columns
-    fatigue_data = {q.replace(" ", "_").lower(): submission.responses[q] for q in FATIGUE_QUESTIONS}
     fatigue_data["user_id"] = submission.user_id
     fatigue_data["total_sum"] = total_sum
     fatigue_data["question_mn"] = question_mn
     
-    # Use the Fatigue model
-    new_fatigue = Fatigue(**fatigue_data)
-    db.add(new_fatigue)
-    db.commit()
-    db.refresh(new_fatigue)
+    # Queue for batched insert into Fatigue table
+    await enqueue_survey_row(FATIGUE_INSERT, fatigue_data)
     
     return {"question_mn": question_mn}
\ No newline at end of file
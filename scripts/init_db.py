@@ -0,0 +1,18 @@
+# Create database tables once, before starting the API workers:
+#   python scripts/init_db.py && uvicorn main:app
+import asyncio
+import sys
+from os.path import join, dirname
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+from main import get_engine, init_models
+
+
+async def main():
+    await init_models()
+    await get_engine().dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())